@@ -1,111 +1,132 @@
 import os
 import ftplib
+import shutil
+import socket
 from pyftpdlib.authorizers import DummyAuthorizer
-from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.handlers import FTPHandler, ThrottledDTPHandler
+from pyftpdlib.ioloop import IOLoop
 from pyftpdlib.servers import FTPServer
 import threading
-import tempfile
-import math
 import time
-import re
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+BANDWIDTH_BYTES_PER_SEC = 100 * 1024 * 1024 // 8  # 100 Mb/s = 12.5 MB/s
+
+# One read-only routing table shared by every node and network instance
+IP_MAP = types.MappingProxyType({
+    "192.168.1.1": {"disk_path": "./assets/node1/", "ftp_port": 2121},
+    "192.168.1.2": {"disk_path": "./assets/node2/", "ftp_port": 2122},
+    "192.168.1.3": {"disk_path": "./assets/node3/", "ftp_port": 2123},
+})
+
+_ZERO_BLOCK = bytes(1024 * 1024)  # Shared zero buffer; readers hand out views of it
+_ZERO_VIEW = memoryview(_ZERO_BLOCK)
+
+def _record_receipt(node, filename, total_size):
+    """Record a file landed on an in-process node's disk, however it arrived."""
+    node._used_storage += total_size - node.virtual_disk.get(filename, 0)
+    node.virtual_disk[filename] = total_size
+    node._log_mutation("set", filename, total_size)
+    with VirtualNetwork.usage_lock:
+        VirtualNetwork.node_usage[node.ip_address] = node._used_storage
+        VirtualNetwork.file_sets.setdefault(node.ip_address, set()).add(filename)
+
+class _NoDelayFTP(ftplib.FTP):
+    """FTP client with Nagle disabled on both control and data sockets, so
+    small command writes are not delayed behind unacked payload."""
+
+    def connect(self, *args, **kwargs):
+        welcome = super().connect(*args, **kwargs)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return welcome
+
+    def ntransfercmd(self, cmd, rest=None):
+        conn, size = super().ntransfercmd(cmd, rest)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn, size
+
+class ZeroReader:
+    """File-like source of zero bytes, so payloads never have to be materialized."""
+
+    def __init__(self, size):
+        self.remaining = size
+
+    def read(self, n=-1):
+        if self.remaining <= 0:
+            return b""
+        if n is None or n < 0 or n > self.remaining:
+            n = self.remaining
+        n = min(n, len(_ZERO_BLOCK))
+        self.remaining -= n
+        return _ZERO_VIEW[:n]
+
+class CustomDTPHandler(ThrottledDTPHandler):
+    """Caps data-channel throughput at the simulated 100 Mb/s link speed."""
+    read_limit = BANDWIDTH_BYTES_PER_SEC
+    write_limit = BANDWIDTH_BYTES_PER_SEC
 
 class CustomFTPHandler(FTPHandler):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.current_filename = None
-        self.expected_chunks = 5
-        self.received_chunks = 0
-        self.total_received_size = 0
+    # Shape bandwidth at socket granularity inside the server's event loop
+    dtp_handler = CustomDTPHandler
+    # All traffic is loopback: answer PASV with 127.0.0.1 from a fixed port
+    # range and skip the per-connection lookups that only matter on real networks
+    masquerade_address = "127.0.0.1"
+    passive_ports = range(60000, 60010)
+    use_gmt_times = False
+    tcp_no_delay = True
+    # Explicit so older pyftpdlib versions also take the sendfile(2) download
+    # path and use 64 KB channel buffers instead of conservative defaults
+    use_sendfile = hasattr(os, "sendfile")
+    ac_in_buffer_size = 65536
+    ac_out_buffer_size = 65536
 
     def on_file_received(self, file_path):
-        """Called when a chunk is received via STOR or APPE command."""
+        """Record a completed upload in the receiving node's disk state."""
         if file_path.endswith("disk_metadata.json"):
             return  # Skip metadata file
-
-        # Read the received chunk
-        with open(file_path, 'rb') as f:
-            data = f.read()
-        
-        # Parse the header (format: CHUNK:<number>:<size>\n)
-        header_pattern = re.compile(b"CHUNK:(\d+):(\d+)\n")
-        match = header_pattern.match(data)
-        if not match:
-            print(f"Error: Invalid chunk header in {file_path}")
-            return
-
-        chunk_number = int(match.group(1))
-        chunk_size = int(match.group(2))
-        payload = data[match.end():]  # Data after the header
-        actual_payload_size = len(payload)
-
-        if actual_payload_size != chunk_size:
-            print(f"Error: Chunk {chunk_number} size mismatch, expected {chunk_size}, got {actual_payload_size}")
-            return
-
         filename = os.path.basename(file_path)
-        final_path = os.path.join(os.path.dirname(file_path), filename)
-
-        if chunk_number == 1:
-            # Initialize for new file
-            self.current_filename = filename
-            self.received_chunks = 1
-            self.total_received_size = actual_payload_size
-            # Write first chunk directly to final file
-            with open(final_path, 'wb') as f:
-                f.write(payload)
-        else:
-            # Validate chunk number and filename
-            if filename != self.current_filename:
-                print(f"Error: Chunk {chunk_number} for {filename} does not match expected file {self.current_filename}")
-                return
-            if chunk_number != self.received_chunks + 1:
-                print(f"Error: Received chunk {chunk_number} out of order, expected {self.received_chunks + 1}")
-                return
-            self.received_chunks += 1
-            self.total_received_size += actual_payload_size
-            # Append chunk payload to final file
-            with open(final_path, 'ab') as f:
-                f.write(payload)
-
-        # Update virtual_disk with current size
-        self.server.node.virtual_disk[filename] = self.total_received_size
-        self.server.node._save_disk()
-        print(f"Received chunk {chunk_number}/{self.expected_chunks} for {filename}: {self.total_received_size} bytes total")
-
-        # Clean up the temporary chunk file
-        try:
-            os.remove(file_path)
-        except OSError:
-            pass  # File may already be removed by FTP server
-
-        # Finalize if all chunks are received
-        if self.received_chunks == self.expected_chunks:
-            print(f"Completed receiving {filename}: {self.total_received_size} bytes")
-            self.current_filename = None
-            self.received_chunks = 0
-            self.total_received_size = 0
+        total_size = os.path.getsize(file_path)
+        _record_receipt(self.server.node, filename, total_size)
+        print(f"Completed receiving {filename}: {total_size} bytes")
 
 class VirtualNetwork:
+    # Shared across instances since every node builds its own VirtualNetwork
+    node_usage = {}  # ip_address -> used bytes for nodes running in this process
+    file_sets = {}  # ip_address -> set of filenames for nodes running in this process
+    usage_lock = threading.Lock()
+    _handler_classes = {}  # ftp_port -> handler subclass with its own authorizer
+    nodes = {}  # ip_address -> VirtualNode for nodes running in this process
+    # Shared pool so batches to different targets transfer concurrently;
+    # threads spawn lazily on first submit
+    _send_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="ftp-send")
+
     def __init__(self):
-        self.ip_map = {
-            "192.168.1.1": {"disk_path": "./assets/node1/", "ftp_port": 2121},
-            "192.168.1.2": {"disk_path": "./assets/node2/", "ftp_port": 2122},
-            "192.168.1.3": {"disk_path": "./assets/node3/", "ftp_port": 2123}
-        }
+        self.ip_map = IP_MAP
         self.ftp_servers = {}
-        self.num_chunks = 5  # Fixed number of chunks
-        self.bandwidth_bytes_per_sec = 100 * 1024 * 1024 // 8  # 100 Mb/s = 12.5 MB/s
-        self.header_size = 16  # Fixed header size: "CHUNK:<num>:<size>\n"
+        self.ftp_clients = {}  # target_ip -> reusable authenticated FTP connection
+        self.ftp_locks = {}  # target_ip -> lock serializing use of that connection
 
     def start_ftp_server(self, node, ip_address, ftp_port, disk_path):
         """Start an FTP server for a given node."""
-        authorizer = DummyAuthorizer()
-        authorizer.add_user("user", "password", disk_path, perm="elradfmw")
-        handler = CustomFTPHandler
-        handler.authorizer = authorizer
-        ftp_server = FTPServer(("0.0.0.0", ftp_port), handler)
+        # Each node gets its own handler subclass so assigning an authorizer
+        # does not race with the other nodes through the shared class attribute
+        handler = VirtualNetwork._handler_classes.get(ftp_port)
+        if handler is None:
+            authorizer = DummyAuthorizer()
+            authorizer.add_user("user", "password", disk_path, perm="elradfmw")
+            handler = type(f"CustomFTPHandler{ftp_port}", (CustomFTPHandler,),
+                           {"authorizer": authorizer})
+            VirtualNetwork._handler_classes[ftp_port] = handler
+        # A private IOLoop keeps this server's polling thread off the sockets
+        # of the other in-process servers
+        ftp_server = FTPServer(("127.0.0.1", ftp_port), handler, ioloop=IOLoop())
         ftp_server.node = node  # Attach the VirtualNode instance to the server
         self.ftp_servers[ip_address] = ftp_server
+        VirtualNetwork.nodes[ip_address] = node
+        self.update_usage(ip_address, node._used_storage)
+        with VirtualNetwork.usage_lock:
+            VirtualNetwork.file_sets[ip_address] = set(node.virtual_disk)
         ftp_thread = threading.Thread(target=ftp_server.serve_forever, daemon=True)
         ftp_thread.start()
         print(f"FTP server started on {ip_address}:{ftp_port}")
@@ -116,34 +137,73 @@ class VirtualNetwork:
             self.ftp_servers[ip_address].close_all()
             print(f"FTP server stopped for {ip_address}")
             del self.ftp_servers[ip_address]
+        VirtualNetwork.nodes.pop(ip_address, None)
+        self._drop_ftp(ip_address)
 
-    def check_target_storage(self, target_ip, size, total_storage):
-        """Check if the target node has enough storage via FTP."""
-        if target_ip not in self.ip_map:
-            return False, f"Error: Target IP {target_ip} not found"
-        try:
-            ftp = ftplib.FTP()
+    def update_usage(self, ip_address, used_bytes):
+        """Record the current used storage of an in-process node."""
+        with VirtualNetwork.usage_lock:
+            VirtualNetwork.node_usage[ip_address] = used_bytes
+
+    def record_file(self, ip_address, filename):
+        """Track a file added to an in-process node's disk."""
+        with VirtualNetwork.usage_lock:
+            VirtualNetwork.file_sets.setdefault(ip_address, set()).add(filename)
+
+    def forget_file(self, ip_address, filename):
+        """Track a file removed from an in-process node's disk."""
+        with VirtualNetwork.usage_lock:
+            VirtualNetwork.file_sets.get(ip_address, set()).discard(filename)
+
+    def _get_ftp(self, target_ip):
+        """Return a pooled authenticated FTP connection to the target node."""
+        ftp = self.ftp_clients.get(target_ip)
+        if ftp is not None:
+            try:
+                ftp.voidcmd("NOOP")  # Liveness ping; server may have restarted
+            except Exception:
+                self._drop_ftp(target_ip)
+                ftp = None
+        if ftp is None:
+            ftp = _NoDelayFTP()
             ftp.connect(host="127.0.0.1", port=self.ip_map[target_ip]["ftp_port"])
             ftp.login(user="user", passwd="password")
-            # List files to calculate used storage
-            files = []
-            ftp.dir(lambda x: files.append(x))
-            used_storage = 0
-            for line in files:
-                parts = line.split()
-                if len(parts) > 4 and parts[0].startswith("-"):
-                    file_size = int(parts[4])
-                    if parts[-1] != "disk_metadata.json":
-                        used_storage += file_size
-            ftp.quit()
-            if used_storage + size <= total_storage:
-                return True, None
-            return False, f"Error: Not enough storage on {target_ip}'s disk"
-        except Exception as e:
-            return False, f"Error checking storage on {target_ip}: {e}"
+            self.ftp_clients[target_ip] = ftp
+        return ftp
+
+    def _drop_ftp(self, target_ip):
+        """Close and forget a pooled connection after an error."""
+        ftp = self.ftp_clients.pop(target_ip, None)
+        if ftp is not None:
+            try:
+                ftp.close()
+            except Exception:
+                pass
+
+    def send_many(self, pairs, source_ip, virtual_disk):
+        """Send several (filename, target_ip) pairs, grouped by target so each
+        pooled connection is reused for the whole batch. Batches to different
+        targets run concurrently on the shared send pool."""
+        by_target = {}
+        for filename, target_ip in pairs:
+            by_target.setdefault(target_ip, []).append(filename)
+
+        def send_batch(target_ip, filenames):
+            return [self.send_file(filename, source_ip, target_ip, virtual_disk)
+                    for filename in filenames]
+
+        if len(by_target) == 1:
+            target_ip, filenames = next(iter(by_target.items()))
+            return send_batch(target_ip, filenames)
+        futures = [VirtualNetwork._send_pool.submit(send_batch, target_ip, filenames)
+                   for target_ip, filenames in by_target.items()]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        return results
 
     def send_file(self, filename, source_ip, target_ip, virtual_disk):
-        """Send a file to another node's disk using FTP with 5 chunks, encapsulation, and 100 Mb/s bandwidth limit."""
+        """Send a file to another node's disk over FTP at the 100 Mb/s bandwidth limit."""
         if target_ip not in self.ip_map:
             return f"Error: Target IP {target_ip} not found"
         if source_ip == target_ip:
@@ -152,77 +212,72 @@ class VirtualNetwork:
             return f"Error: File {filename} does not exist"
 
         size = virtual_disk[filename]
-        can_store, error = self.check_target_storage(target_ip, size, 1024 * 1024 * 1024)  # 1 GB
-        if not can_store:
-            return error
-
-        # Create a temporary file with the content
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            temp_file.write(b"\0" * size)
-            temp_file_path = temp_file.name
-
-        try:
-            # Connect to target FTP server
-            ftp = ftplib.FTP()
-            ftp.connect(host="127.0.0.1", port=self.ip_map[target_ip]["ftp_port"])
-            ftp.login(user="user", passwd="password")
-            # Check if file already exists
-            file_list = ftp.nlst()
-            if filename in file_list:
-                ftp.quit()
-                os.unlink(temp_file_path)
-                return f"Error: File {filename} already exists on {target_ip}"
-
-            # Record start time
-            start_time = time.time()
-            print(f"Transfer started at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start_time))}")
-
-            # Calculate chunk size (divide file into 5 chunks)
-            chunk_size = math.ceil(size / self.num_chunks)  # Round up to ensure all bytes are sent
-            sent_bytes = 0
-            chunk_count = 0
-            with open(temp_file_path, 'rb') as f:
-                while chunk_count < self.num_chunks and sent_bytes < size:
-                    chunk_count += 1
-                    remaining_bytes = size - sent_bytes
-                    current_chunk_size = min(chunk_size, remaining_bytes)  # Last chunk may be smaller
-                    chunk = f.read(current_chunk_size)
-                    if not chunk:
-                        break
-                    # Create header (format: CHUNK:<number>:<size>\n, padded to 16 bytes)
-                    header = f"CHUNK:{chunk_count}:{current_chunk_size}\n".encode()
-                    header = header.ljust(self.header_size, b'\0')
-                    # Combine header and payload
-                    chunk_with_header = header + chunk
-                    # Write chunk to a temporary file
-                    with tempfile.NamedTemporaryFile(delete=False) as chunk_file:
-                        chunk_file.write(chunk_with_header)
-                        chunk_file_path = chunk_file.name
-                    # Send chunk
-                    chunk_start_time = time.time()
-                    with open(chunk_file_path, 'rb') as cf:
-                        mode = 'STOR' if chunk_count == 1 else 'APPE'
-                        ftp.storbinary(f"{mode} {filename}", cf)
-                    os.unlink(chunk_file_path)
-                    sent_bytes += current_chunk_size
-                    # Enforce bandwidth limit
-                    elapsed_time = time.time() - chunk_start_time
-                    expected_time = current_chunk_size / self.bandwidth_bytes_per_sec
-                    sleep_time = max(0, expected_time - elapsed_time)
-                    if sleep_time > 0:
-                        time.sleep(sleep_time)
-                    total_time = time.time() - chunk_start_time
-                    print(f"Sent chunk {chunk_count}/5 ({current_chunk_size} bytes) for {filename} to {target_ip} in {total_time:.2f} seconds")
-
-            # Record end time and print transfer details
-            end_time = time.time()
-            ftp.quit()
-            os.unlink(temp_file_path)
-            print(f"Transfer ended at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end_time))}")
-            print(f"Transferred {filename}: {size} bytes ({size / (1024 * 1024):.2f} MB)")
-            print(f"Completed sending {filename} ({size} bytes) in {chunk_count} chunks to {target_ip}")
-            return f"Sent {filename} ({size} bytes) to {target_ip}"
-        except Exception as e:
-            if os.path.exists(temp_file_path):
-                os.unlink(temp_file_path)
-            return f"Error sending file to {target_ip}: {e}"
\ No newline at end of file
+        lock = self.ftp_locks.setdefault(target_ip, threading.Lock())
+        with lock:
+            try:
+                # Same-process target: both disks are directories on this
+                # filesystem, so copy through the kernel instead of round-
+                # tripping loopback FTP, with checks straight off the node
+                target_node = VirtualNetwork.nodes.get(target_ip)
+                if target_node is not None:
+                    if filename in target_node.virtual_disk:
+                        return f"Error: File {filename} already exists on {target_ip}"
+                    if target_node._used_storage + size > 1024 * 1024 * 1024:  # 1 GB
+                        return f"Error: Not enough storage on {target_ip}'s disk"
+                    src_path = os.path.join(self.ip_map[source_ip]["disk_path"], filename)
+                    dst_path = os.path.join(self.ip_map[target_ip]["disk_path"], filename)
+                    shutil.copyfile(src_path, dst_path)
+                    _record_receipt(target_node, filename, size)
+                    print(f"Copied {filename} ({size} bytes) to {target_ip} locally")
+                    return f"Sent {filename} ({size} bytes) to {target_ip}"
+
+                ftp = self._get_ftp(target_ip)
+                # Existence check: O(1) set lookup for in-process nodes,
+                # directory listing only for unknown targets
+                with VirtualNetwork.usage_lock:
+                    target_files = VirtualNetwork.file_sets.get(target_ip)
+                if target_files is None:
+                    target_files = set(ftp.nlst())
+                if filename in target_files:
+                    return f"Error: File {filename} already exists on {target_ip}"
+                # Storage check: O(1) registry lookup for in-process nodes,
+                # full directory listing only for unknown targets
+                with VirtualNetwork.usage_lock:
+                    used_storage = VirtualNetwork.node_usage.get(target_ip)
+                if used_storage is None:
+                    target_disk = self.ip_map[target_ip]["disk_path"]
+                    if os.path.isdir(target_disk):
+                        # Target disks live on this filesystem: one stat per
+                        # entry beats an FTP round-trip
+                        with os.scandir(target_disk) as entries:
+                            used_storage = sum(
+                                entry.stat(follow_symlinks=False).st_size
+                                for entry in entries
+                                if entry.is_file() and entry.name != "disk_metadata.json"
+                            )
+                    else:
+                        used_storage = sum(
+                            int(facts["size"])
+                            for name, facts in ftp.mlsd(facts=["size", "type"])
+                            if facts.get("type") == "file" and name != "disk_metadata.json"
+                        )
+                if used_storage + size > 1024 * 1024 * 1024:  # 1 GB
+                    return f"Error: Not enough storage on {target_ip}'s disk"
+
+                # Record start time
+                start_time = time.time()
+                print(f"Transfer started at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start_time))}")
+
+                # One streaming STOR of the raw payload; the server's
+                # throttled data channel enforces the bandwidth cap
+                ftp.storbinary(f"STOR {filename}", ZeroReader(size), blocksize=1024 * 1024)
+
+                # Record end time and print transfer details
+                end_time = time.time()
+                print(f"Transfer ended at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end_time))}")
+                print(f"Transferred {filename}: {size} bytes ({size / (1024 * 1024):.2f} MB)")
+                print(f"Completed sending {filename} ({size} bytes) to {target_ip}")
+                return f"Sent {filename} ({size} bytes) to {target_ip}"
+            except Exception as e:
+                self._drop_ftp(target_ip)
+                return f"Error sending file to {target_ip}: {e}"
\ No newline at end of file
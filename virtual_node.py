@@ -1,8 +1,29 @@
 import os
 import json
-from virtual_network import VirtualNetwork
+from virtual_network import VirtualNetwork, IP_MAP
+
+try:
+    import orjson  # Much faster C-based JSON for the metadata file
+except ImportError:
+    orjson = None
+
+_disk_cache = {}  # metadata path -> (st_mtime_ns, parsed dict)
+
+def _read_disk(path):
+    """Parse a disk metadata file, reusing the cached result while it is unchanged."""
+    st = os.stat(path)
+    entry = _disk_cache.get(path)
+    if entry and entry[0] == st.st_mtime_ns:
+        return entry[1]
+    with open(path, 'rb') as f:
+        raw = f.read()
+    data = orjson.loads(raw) if orjson else json.loads(raw)
+    _disk_cache[path] = (st.st_mtime_ns, data)
+    return data
 
 class VirtualNode:
+    _dirs_created = set()  # Disk directories already created in this process
+
     def __init__(self, name, disk_path, ip_address, ftp_port):
         self.name = name
         self.disk_path = disk_path
@@ -12,54 +33,104 @@ class VirtualNode:
         self.virtual_disk = {}  # Dictionary to simulate disk (filename: size)
         self.memory = {}  # Dictionary to simulate RAM (variable: value)
         self.is_running = False  # VM running state
-        self.ip_map = {
-            "192.168.1.1": {"disk_path": "./assets/node1/", "ftp_port": 2121},
-            "192.168.1.2": {"disk_path": "./assets/node2/", "ftp_port": 2122},
-            "192.168.1.3": {"disk_path": "./assets/node3/", "ftp_port": 2123}
-        }  # Mapping of IP addresses to disk paths and FTP ports
+        self.ip_map = IP_MAP  # Shared read-only routing table
         self.network = VirtualNetwork()
+        # Dispatch table for run_interactive; handlers return None on bad arity
+        self._cmd_table = {
+            "ls": lambda args: self.ls(),
+            "touch": lambda args: self.touch(args[1], args[2] if len(args) > 2 and args[2].isdigit() else 0) if len(args) > 1 else None,
+            "trunc": lambda args: self.trunc(args[1], args[2] if len(args) > 2 and args[2].isdigit() else 0) if len(args) > 1 else None,
+            "send": lambda args: self.send(args[1], args[2]) if len(args) == 3 else None,
+            "sendmany": lambda args: self.sendmany(args[1:-1], args[-1]) if len(args) >= 3 else None,
+            "del": lambda args: self.del_file(args[1]) if len(args) == 2 else None,
+            "diskprop": lambda args: self.diskprop() if len(args) == 1 else None,
+            "set": lambda args: self.set_var(args[1], args[2]) if len(args) == 3 else None,
+            "get": lambda args: self.get_var(args[1]) if len(args) == 2 else None,
+            "add": lambda args: self.execute_instruction_args(args[1], args[2]) if len(args) == 3 else None,
+        }
         self._initialize_disk()
         self.network.start_ftp_server(self, ip_address, ftp_port, disk_path)
         self.start()  # Automatically start the VM on initialization
 
     def _initialize_disk(self):
         """Initialize or load the virtual disk from disk_path."""
-        os.makedirs(self.disk_path, exist_ok=True)
+        if self.disk_path not in VirtualNode._dirs_created:
+            os.makedirs(self.disk_path, exist_ok=True)
+            VirtualNode._dirs_created.add(self.disk_path)
         metadata_path = os.path.join(self.disk_path, "disk_metadata.json")
         if os.path.exists(metadata_path):
             try:
-                with open(metadata_path, 'r') as f:
-                    self.virtual_disk = json.load(f)
-                    # Ensure sizes are integers
-                    self.virtual_disk = {k: int(v) for k, v in self.virtual_disk.items()}
-            except (json.JSONDecodeError, IOError):
+                # Ensure sizes are integers (also copies the cached dict)
+                self.virtual_disk = {k: int(v) for k, v in _read_disk(metadata_path).items()}
+            except (ValueError, IOError):
                 print(f"Warning: Could not load metadata from {metadata_path}. Starting with empty disk.")
                 self.virtual_disk = {}
         else:
             self.virtual_disk = {}
             self._save_disk()
+        # Replay mutations journaled since the last snapshot
+        journal_path = os.path.join(self.disk_path, "disk_metadata.log")
+        if os.path.exists(journal_path):
+            try:
+                with open(journal_path, 'r') as f:
+                    for line in f:
+                        try:
+                            op, fname, size = line.rstrip("\n").split("\t")
+                        except ValueError:
+                            continue
+                        if op == "set":
+                            self.virtual_disk[fname] = int(size)
+                        elif op == "del":
+                            self.virtual_disk.pop(fname, None)
+            except IOError:
+                print(f"Warning: Could not replay journal from {journal_path}.")
         # Sync virtual_disk with actual files
         for filename in os.listdir(self.disk_path):
-            if filename != "disk_metadata.json":
+            if filename not in ("disk_metadata.json", "disk_metadata.log"):
                 file_path = os.path.join(self.disk_path, filename)
                 if os.path.isfile(file_path):
                     size = os.path.getsize(file_path)
                     self.virtual_disk[filename] = size
+        self._used_storage = sum(self.virtual_disk.values())
         self._save_disk()
+        # The snapshot is current again, so start from an empty journal
+        self._journal = open(journal_path, 'w')
 
     def _save_disk(self):
         """Save the virtual disk metadata to disk_path."""
         metadata_path = os.path.join(self.disk_path, "disk_metadata.json")
         try:
-            with open(metadata_path, 'w') as f:
-                json.dump(self.virtual_disk, f)
+            if orjson:
+                data = orjson.dumps(self.virtual_disk)
+            else:
+                data = json.dumps(self.virtual_disk).encode()
+            with open(metadata_path, 'wb') as f:
+                f.write(data)
         except IOError as e:
             print(f"Error saving metadata to {metadata_path}: {e}")
 
+    def _log_mutation(self, op, filename, size):
+        """Append one mutation to the journal, O(1) vs re-serializing the dict."""
+        try:
+            self._journal.write(f"{op}\t{filename}\t{size}\n")
+            self._journal.flush()
+        except (IOError, ValueError):
+            print(f"Error journaling {op} {filename} for {self.name}")
+
+    def _compact_disk(self):
+        """Write a full metadata snapshot and truncate the journal."""
+        self._save_disk()
+        try:
+            # Rewind before truncating so later mutations start at offset 0
+            # instead of leaving a NUL-padded hole the replay cannot parse
+            self._journal.seek(0)
+            self._journal.truncate(0)
+        except (IOError, ValueError):
+            pass
+
     def _check_storage(self, size):
         """Check if there's enough storage for a given size."""
-        used_storage = sum(self.virtual_disk.values())
-        return used_storage + size <= self.total_storage
+        return self._used_storage + size <= self.total_storage
 
     def send(self, filename, target_ip):
         """Send a file to another node's disk using the VirtualNetwork."""
@@ -67,10 +138,20 @@ class VirtualNode:
             return f"Error: VM {self.name} is not running"
         return self.network.send_file(filename, self.ip_address, target_ip, self.virtual_disk)
 
+    def sendmany(self, filenames, target_ip):
+        """Send several files to another node over one FTP session."""
+        if not self.is_running:
+            return f"Error: VM {self.name} is not running"
+        pairs = [(filename, target_ip) for filename in filenames]
+        return "\n".join(self.network.send_many(pairs, self.ip_address, self.virtual_disk))
+
     def start(self):
         """Start the virtual machine."""
         if self.is_running:
             return f"VM {self.name} is already running"
+        if self._journal.closed:
+            journal_path = os.path.join(self.disk_path, "disk_metadata.log")
+            self._journal = open(journal_path, 'w')
         self.is_running = True
         return f"VM {self.name} started"
 
@@ -79,7 +160,8 @@ class VirtualNode:
         if not self.is_running:
             return f"VM {self.name} is already stopped"
         self.is_running = False
-        self._save_disk()
+        self._compact_disk()
+        self._journal.close()
         self.network.stop_ftp_server(self.ip_address)
         return f"VM {self.name} stopped"
 
@@ -106,10 +188,18 @@ class VirtualNode:
             if not self._check_storage(size_bytes):
                 return f"Error: Not enough storage on disk"
             file_path = os.path.join(self.disk_path, filename)
-            with open(file_path, 'wb') as f:
-                f.write(b"\0" * size_bytes)
+            # ftruncate extends the file as a sparse region: O(1) metadata
+            # update instead of materializing and writing size_bytes of zeros
+            fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.ftruncate(fd, size_bytes)
+            finally:
+                os.close(fd)
             self.virtual_disk[filename] = size_bytes
-            self._save_disk()
+            self._used_storage += size_bytes
+            self._log_mutation("set", filename, size_bytes)
+            self.network.update_usage(self.ip_address, self._used_storage)
+            self.network.record_file(self.ip_address, filename)
             return f"Created file: {filename} with {size_bytes} bytes ({size} MB)"
         else:
             os.utime(os.path.join(self.disk_path, filename))
@@ -130,10 +220,17 @@ class VirtualNode:
             if not self._check_storage(size_bytes - self.virtual_disk[filename]):
                 return f"Error: Not enough storage on disk"
             file_path = os.path.join(self.disk_path, filename)
-            with open(file_path, 'wb') as f:
-                f.write(b"\0" * size_bytes)
+            # ftruncate extends the file as a sparse region: O(1) metadata
+            # update instead of materializing and writing size_bytes of zeros
+            fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.ftruncate(fd, size_bytes)
+            finally:
+                os.close(fd)
+            self._used_storage += size_bytes - self.virtual_disk[filename]
             self.virtual_disk[filename] = size_bytes
-            self._save_disk()
+            self._log_mutation("set", filename, size_bytes)
+            self.network.update_usage(self.ip_address, self._used_storage)
             return f"Truncated {filename} to {size_bytes} bytes ({size} MB)"
         else:
             return f"File {filename} does not exist"
@@ -152,8 +249,11 @@ class VirtualNode:
                 except OSError as e:
                     print(f"Error deleting {fname}: {e}")
             for fname in deleted_files:
+                self._used_storage -= self.virtual_disk[fname]
                 del self.virtual_disk[fname]
-            self._save_disk()
+                self._log_mutation("del", fname, 0)
+                self.network.forget_file(self.ip_address, fname)
+            self.network.update_usage(self.ip_address, self._used_storage)
             return f"Deleted {len(deleted_files)} file(s)" if deleted_files else "No files to delete"
         else:
             if filename not in self.virtual_disk:
@@ -161,8 +261,11 @@ class VirtualNode:
             file_path = os.path.join(self.disk_path, filename)
             try:
                 os.remove(file_path)
+                self._used_storage -= self.virtual_disk[filename]
                 del self.virtual_disk[filename]
-                self._save_disk()
+                self._log_mutation("del", filename, 0)
+                self.network.update_usage(self.ip_address, self._used_storage)
+                self.network.forget_file(self.ip_address, filename)
                 return f"Deleted {filename}"
             except OSError as e:
                 return f"Error deleting {filename}: {e}"
@@ -172,7 +275,7 @@ class VirtualNode:
         if not self.is_running:
             return f"Error: VM {self.name} is not running"
         total_size_bytes = self.total_storage
-        occupied_size_bytes = sum(self.virtual_disk.values())
+        occupied_size_bytes = self._used_storage
         free_size_bytes = total_size_bytes - occupied_size_bytes
         # Convert to requested units
         total_size_gb = total_size_bytes / (1024 * 1024 * 1024)  # Bytes to GB
@@ -212,15 +315,20 @@ class VirtualNode:
         cmd = parts[0].lower()
         if cmd == "add":
             if len(parts) == 3:
-                var1, var2 = parts[1], parts[2]
-                if var1 in self.memory and var2 in self.memory:
-                    result = self.memory[var1] + self.memory[var2]
-                    self.memory["result"] = result
-                    return f"Added {var1} + {var2}, stored result = {result}"
-                return "Error: Variables not found"
+                return self.execute_instruction_args(parts[1], parts[2])
             return "Error: Usage: add <var1> <var2>"
         return "Unknown instruction"
 
+    def execute_instruction_args(self, var1, var2):
+        """Simulate CPU by adding two already-parsed memory variables."""
+        if not self.is_running:
+            return f"Error: VM {self.name} is not running"
+        if var1 in self.memory and var2 in self.memory:
+            result = self.memory[var1] + self.memory[var2]
+            self.memory["result"] = result
+            return f"Added {var1} + {var2}, stored result = {result}"
+        return "Error: Variables not found"
+
     def __str__(self):
         status = "running" if self.is_running else "stopped"
         return f"VirtualNode({self.name}, IP: {self.ip_address}, Status: {status}, Files: {len(self.virtual_disk)}, Memory: {len(self.memory)} variables)"
@@ -234,31 +342,15 @@ class VirtualNode:
                 if not command:
                     continue
                 cmd = command[0].lower()
-                if cmd == "ls":
-                    print(self.ls())
-                elif cmd == "touch" and len(command) > 1:
-                    size = int(command[2]) if len(command) > 2 and command[2].isdigit() else 0
-                    print(self.touch(command[1], size))
-                elif cmd == "trunc" and len(command) > 1:
-                    size = int(command[2]) if len(command) > 2 and command[2].isdigit() else 0
-                    print(self.trunc(command[1], size))
-                elif cmd == "send" and len(command) == 3:
-                    print(self.send(command[1], command[2]))
-                elif cmd == "del" and len(command) == 2:
-                    print(self.del_file(command[1]))
-                elif cmd == "diskprop" and len(command) == 1:
-                    print(self.diskprop())
-                elif cmd == "set" and len(command) == 3:
-                    print(self.set_var(command[1], command[2]))
-                elif cmd == "get" and len(command) == 2:
-                    print(self.get_var(command[1]))
-                elif cmd == "add" and len(command) == 3:
-                    print(self.execute_instruction(" ".join(command)))
-                elif cmd == "stop":
+                if cmd == "stop":
                     print(self.stop())
                     break
+                handler = self._cmd_table.get(cmd)
+                result = handler(command) if handler else None
+                if result is not None:
+                    print(result)
                 else:
-                    print("Invalid command. Use: ls, touch <filename> [size], trunc <filename> [size], send <filename> <ip_address>, del <filename|all>, diskprop, stop")
+                    print("Invalid command. Use: ls, touch <filename> [size], trunc <filename> [size], send <filename> <ip_address>, sendmany <filename>... <ip_address>, del <filename|all>, diskprop, stop")
             except EOFError:
                 print("\nEOF detected. Stopping VM.")
                 print(self.stop())